@@ -244,7 +244,8 @@ def LexFormats():
        file as a parameter. """
   
   phonemes = Phonemes() ; globals().update(phonemes)
-  return { "festival" : makeDic(
+  phoneme_ids[:] = sorted(phonemes.values()) ; phoneme_codes.clear() ; phoneme_codes.update((v,i) for i,v in enumerate(phoneme_ids))
+  formats = { "festival" : makeDic(
     "Festival's British voice",
     ('0',syllable_separator),
     ('1',primary_stress),
@@ -297,7 +298,7 @@ def LexFormats():
     lex_filename=ifset("HOME",os.environ.get("HOME","")+os.sep)+".festivalrc",
     lex_entry_format="(lex.add.entry '( \"%s\" n %s))\n",
     lex_header=";; -*- mode: lisp -*-\n(eval (list voice_default))\n",
-    lex_read_function = lambda *args:eval('['+commands.getoutput("grep -vi parameter.set < ~/.festivalrc | grep -v '(eval' | sed -e 's/;.*//' -e 's/.lex.add.entry//' -e s/\"'\"'[(] *\"/[\"/' -e 's/\" [^ ]* /\",(\"/' -e 's/\".*$/&\"],/' -e 's/[()]/ /g' -e 's/  */ /g'")+']'),
+    lex_read_function = read_festival_lexicon,
     safe_to_drop_characters=True, # TODO: really? (could instead give a string of known-safe characters)
     cleanup_func = festival_group_stress,
   ),
@@ -415,7 +416,7 @@ def LexFormats():
     ('Z',ge_of_blige_etc),
     lex_filename = "en_extra",
     lex_entry_format = "%s %s\n",
-    lex_read_function = lambda lexfile: [x for x in [l.split()[:2] for l in lexfile.readlines()] if len(x)==2 and not '//' in x[0]],
+    lex_read_function = lambda lexfile: (x for x in (l.split()[:2] for l in lexfile) if len(x)==2 and not '//' in x[0]),
     lex_footer=lambda f:(f.close(),os.system("espeak --compile=en")), # see also a bit of special-case code in mainopt_convert
     inline_format = "[[%s]]",
     word_separator=" ",phoneme_separator="",
@@ -544,7 +545,7 @@ def LexFormats():
     approximate_missing=True,
     lex_filename="lexicon.txt",
     lex_entry_format = "%s 0 %s\n",
-    lex_read_function = lambda lexfile: [(word,pronunc) for word, ignore, pronunc in [l.split(None,2) for l in lexfile.readlines()]],
+    lex_read_function = lambda lexfile: ((word,pronunc) for word, ignore, pronunc in (l.split(None,2) for l in lexfile)),
     lex_word_case = "lower",
     inline_format = "<phoneme ph='%s'>p</phoneme>",
     safe_to_drop_characters=True, # TODO: really?
@@ -662,7 +663,7 @@ def LexFormats():
     ('z',z),
     ('Z',ge_of_blige_etc),
     # lex_filename not set (mac-uk code does not permanently save the lexicon; see --mac-uk option to read text)
-    lex_read_function = lambda *args:[(w,p) for w,_,p in MacBritish_System_Lexicon(False,os.environ.get("MACUK_VOICE","Daniel")).usable_words()],
+    lex_read_function = lambda *args:((w,p) for w,_,p in MacBritish_System_Lexicon(False,os.environ.get("MACUK_VOICE","Daniel")).usable_words()),
     inline_oneoff_header = "(mac-uk phonemes output is for information only; you'll need the --mac-uk or --trymac-uk options to use it)\n",
     word_separator=" ",phoneme_separator="",
     stress_comes_before_vowel=True,
@@ -750,7 +751,7 @@ def LexFormats():
     ('Z',ge_of_blige_etc),
     lex_filename="acapela.txt",
     lex_entry_format = "%s\t#%s\tUNKNOWN\n", # TODO: may be able to convert part-of-speech (NOUN etc) to/from some other formats e.g. Festival
-    lex_read_function=lambda lexfile:[(word,pronunc.lstrip("#")) for word, pronunc, ignore in [l.split(None,2) for l in lexfile.readlines()]],
+    lex_read_function=lambda lexfile:((word,pronunc.lstrip("#")) for word, pronunc, ignore in (l.split(None,2) for l in lexfile)),
     # TODO: inline_format ?
     word_separator=" ",phoneme_separator="",
     safe_to_drop_characters=True, # TODO: really?
@@ -883,7 +884,7 @@ def LexFormats():
     ('Z',ge_of_blige_etc),
     lex_filename="acapela.txt",
     lex_entry_format = "%s\t#%s\tUNKNOWN\n", # TODO: part-of-speech (as above)
-    lex_read_function=lambda lexfile:[(word,pronunc.lstrip("#")) for word, pronunc, ignore in [l.split(None,2) for l in lexfile.readlines()]],
+    lex_read_function=lambda lexfile:((word,pronunc.lstrip("#")) for word, pronunc, ignore in (l.split(None,2) for l in lexfile)),
     inline_format = "\\Prn=%s\\",
     safe_to_drop_characters=True, # TODO: really?
   ),
@@ -1190,7 +1191,7 @@ def LexFormats():
     ('ZH',ge_of_blige_etc),
     lex_filename=ifset("MAKE_SPEECH_ROM","SPEECH.ROM","BBCLEX"),
     lex_entry_format="> %s_"+chr(128)+"%s", # (specifying 'whole word' for now; remove the space before or the _ after if you want)
-    lex_read_function = lambda lexfile: [(w[0].lstrip().rstrip('_').lower(),w[1]) for w in filter(lambda x:len(x)==2,[w.split(chr(128)) for w in lexfile.read().split('>')])], # TODO: this reads back the entries we generate, but is unlikely to work well with the wildcards in the default lexicon that would have been added if SPEECH_DISK was set (c.f. trying to read eSpeak's en_rules instead of en_extra)
+    lex_read_function = lambda lexfile: ((w[0].lstrip().rstrip('_').lower(),w[1]) for w in (w.split(chr(128)) for w in readRecords(lexfile,'>')) if len(w)==2), # TODO: this reads back the entries we generate, but is unlikely to work well with the wildcards in the default lexicon that would have been added if SPEECH_DISK was set (c.f. trying to read eSpeak's en_rules instead of en_extra)
     lex_word_case = "upper",
     lex_header = bbc_prepDefaultLex,
     lex_footer = bbc_appendDefaultLex, # + ">**"
@@ -2006,6 +2007,7 @@ def LexFormats():
   "names" : makeDic(
     "Lexconvert internal phoneme names (sometimes useful with the --phones option while developing new formats)",
      *[(phName,phVal) for phName,phVal in phonemes.items()])}
+  return LazyFormats(formats)
 
 # The mainopt_...() functions are the main options
 # (if you implement a new one, main() will detect it);
@@ -2059,23 +2061,25 @@ def mainopt_phones(i):
 Use eSpeak to convert text to phonemes, and then convert the phonemes to format 'format'.
 E.g.: python lexconvert.py --phones unicode-ipa This is a test sentence.
 Set environment variable PHONES_PIPE_COMMAND to an additional command to which to write the phones as well as standard output.  (If standard input is a terminal then this will be done separately after each line.)
+Set environment variable LEXCONVERT_ESPEAK_POOL to a number of eSpeak processes to keep running and feed line by line, instead of starting eSpeak for each input (quicker, but eSpeak then treats each line separately).
 (Some commercial speech synthesizers do not work well when driven entirely from phonemes, because their internal format is different and is optimised for normal text.)
 Set format to 'all' if you want to see the phonemes in ALL supported formats."""
    format = sys.argv[i+1]
    if format=="example": return "The 'example' format cannot be used with --phones; try --convert, or did you mean --phones festival" # could allow example anyway as it's basically Festival, but save confusion as eSpeak might not generate the same phonemes if our example words haven't been installed in the system's eSpeak.  (Still allow it to be used in --try etc though.)
    if not format in lexFormats and not format=="all": return "No such format "+repr(format)+" (use --formats to see a list of formats)"
+   if not format=="all" and not ' '.join(sys.argv[i+2:]) and not stdin_is_terminal() and not os.environ.get("PHONES_PIPE_COMMAND","") and type(checkSetting(format,"clause_separator","\n")) in [str,unicode] and not (checkSetting(format,"output_is_binary") and hasattr(sys.stdout,"isatty") and sys.stdout.isatty()): return phones_stream(format) # piped input: don't read it all at once
    hadOneoff = False
    for response in getInputText(i+2,"text",'maybe'):
-    response = pipeThroughEspeak(response.replace(u'\u2032'.encode('utf-8'),'').replace(u'\u00b4'.encode('utf-8'),'').replace(u'\u02b9'.encode('utf-8'),'').replace(u'\u00b7'.encode('utf-8'),'')) # (remove any 2032 and b7 pronunciation marks before passing to eSpeak)
+    response = pipeThroughEspeak(removePronunciationMarks(response))
     if not '\n' in response.rstrip() and 'command' in response: return response.strip() # 'bad cmd' / 'cmd not found'
     if format=="all": formats = sorted(k for k in lexFormats.keys() if not k=="example")
     else: formats = [format]
-    for format in formats:
+    for format,clauses in convert_to_all(parseIntoWordsAndClauses("espeak",response),"espeak",formats):
        def out(doOneoff=True):
           if len(formats)>1: writeFormatHeader(format)
           if doOneoff: sys.stdout.write(checkSetting(format,"inline_oneoff_header"))
           sys.stdout.write(checkSetting(format,"inline_header"))
-          output_clauses(format,convert(parseIntoWordsAndClauses("espeak",response),"espeak",format))
+          output_clauses(format,clauses)
           sys.stdout.write(checkSetting(format,"inline_footer"))
           print
           sys.stdout.flush() # in case it's being piped
@@ -2085,6 +2089,31 @@ Set format to 'all' if you want to see the phonemes in ALL supported formats."""
           out()
           sys.stdout = o
 
+def removePronunciationMarks(text): return text.replace(u'\u2032'.encode('utf-8'),'').replace(u'\u00b4'.encode('utf-8'),'').replace(u'\u02b9'.encode('utf-8'),'').replace(u'\u00b7'.encode('utf-8'),'') # (remove any 2032 and b7 pronunciation marks before passing to eSpeak)
+
+def phones_stream(format):
+   "--phones for piped input: reads, converts and writes out a block at a time, so memory use doesn't depend on the length of the input"
+   if get_espeak_pool().size: bufsize = 8192 # (see pipeThroughEspeak)
+   else: bufsize = 1048576 # (one eSpeak process per block, so not too small)
+   clause_sep = checkSetting(format,"clause_separator","\n")
+   started = wroteClauses = False
+   for response in espeakResponses(removePronunciationMarks(block) for block in readBlocks(sys.stdin,bufsize)):
+      if not started:
+         if not '\n' in response.rstrip() and 'command' in response: return response.strip() # 'bad cmd' / 'cmd not found'
+         sys.stdout.write(checkSetting(format,"inline_oneoff_header"))
+         sys.stdout.write(checkSetting(format,"inline_header"))
+         started = True
+      clauses = convert(parseIntoWordsAndClauses("espeak",response),"espeak",format)
+      if not clauses: continue
+      if wroteClauses: sys.stdout.write(clause_sep)
+      output_clauses(format,clauses) ; wroteClauses = True
+      sys.stdout.flush()
+   if not started: # no input
+      sys.stdout.write(checkSetting(format,"inline_oneoff_header"))
+      sys.stdout.write(checkSetting(format,"inline_header"))
+   sys.stdout.write(checkSetting(format,"inline_footer"))
+   print
+
 def mainopt_ruby(i):
    """*<format> [<words>]
 Like --phones but outputs the result as HTML RUBY markup, with each word's pronunciation symbols placed above the corresponding English word.
@@ -2206,10 +2235,158 @@ function h5a(link) {
    if out.endswith("\n"): sys.stdout.write(out)
    else: print out
 
-def pipeThroughEspeak(inpt):
-   "Writes inpt to espeak -q -x (in chunks if necessary) and returns the result"
-   bufsize = 8192 # careful not to set this too big, as the OS might limit it (TODO can we check?)
-   ret = []
+def onPath(cmd): return any(os.path.exists(os.path.join(p,cmd)) for p in os.environ.get("PATH","").split(os.pathsep))
+
+class EspeakWorker(object):
+   "A long-running 'espeak -q -x' process (no text argument, so it reads its input a line at a time) that is given text a line at a time, so we don't have to wait for eSpeak to start and load its voice for every piece of text (see EspeakPool)"
+   sentinel = "Lexconvert sentinel." # written after each piece of text, so we know where eSpeak's response to that text ends
+   timeout = 10 # seconds to wait for eSpeak to say something before deciding it has stopped responding
+   def __init__(self):
+      import subprocess
+      cmd = ["espeak","-q","-x"] # (not --stdin, which makes eSpeak read everything until end of file)
+      if onPath("stdbuf"): cmd = ["stdbuf","-oL"]+cmd # otherwise eSpeak might not write out each line until its buffer is full
+      self.proc = subprocess.Popen(cmd,bufsize=-1,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=open(os.devnull,"w"),close_fds=True)
+      self.buf = ""
+      self.proc.stdin.write(self.sentinel+"\n") ; self.proc.stdin.flush()
+      try: self.sentinelOut = self.readline() # what this eSpeak says for the sentinel
+      except IOError:
+         self.close() ; raise
+      if not self.sentinelOut.strip():
+         self.close() ; raise IOError("Unexpected response from espeak")
+   def readline(self):
+      "Returns the next line of eSpeak's output, or raises IOError if it stops or doesn't say anything for self.timeout seconds"
+      import select
+      while not "\n" in self.buf:
+         if not select.select([self.proc.stdout],[],[],self.timeout)[0]: raise IOError("No response from espeak")
+         out = os.read(self.proc.stdout.fileno(),65536)
+         if not out: raise IOError("espeak stopped unexpectedly")
+         self.buf += out
+      line,self.buf = self.buf.split("\n",1)
+      return line+"\n"
+   def process(self,text):
+      "Returns eSpeak's phonemes for text (which should not be too long, as we don't read the response until we've written all of it)"
+      lines = []
+      for l in text.split("\n"):
+         while len(l) > 900: # eSpeak reads lines of up to 1000 bytes
+            splitAt = l.rfind(' ',0,900)+1 or 900
+            lines.append(l[:splitAt]) ; l = l[splitAt:]
+         lines.append(l)
+      self.proc.stdin.write("\n".join(lines)+"\n"+self.sentinel+"\n") ; self.proc.stdin.flush()
+      ret = []
+      while True:
+         line = self.readline()
+         if line==self.sentinelOut: return "".join(ret)
+         ret.append(line)
+   def close(self):
+      try: self.proc.stdin.close()
+      except IOError: pass
+      if self.proc.poll()==None:
+         try: self.proc.kill()
+         except OSError: pass
+      self.proc.wait()
+
+class EspeakPool(object):
+   "Up to size EspeakWorkers, started when needed and shared by pipeThroughEspeak (safe to use from several threads)"
+   def __init__(self,size):
+      import Queue
+      self.size,self.started,self.idle,self.lock = size,0,Queue.Queue(),threading.Lock()
+   def process(self,text):
+      "Returns eSpeak's phonemes for text, or None if the workers can't be used (so use the normal espeak command instead)"
+      if not self.size: return None
+      with self.lock:
+         startNew = self.idle.empty() and self.started < self.size
+         if startNew: self.started += 1
+      if startNew:
+         try: w = EspeakWorker()
+         except (OSError,IOError): # can't start eSpeak this way, so stop trying
+            self.idle.put(None) ; return None
+      else: w = self.idle.get()
+      if w==None:
+         self.idle.put(None) ; return None
+      try: r = w.process(text)
+      except (OSError,IOError): # worker died or stopped responding (let another be started next time)
+         w.close()
+         with self.lock: self.started -= 1
+         return None
+      self.idle.put(w) ; return r
+espeak_pool = None # set LEXCONVERT_ESPEAK_POOL to the number of eSpeak processes to keep running
+def get_espeak_pool():
+   global espeak_pool
+   if espeak_pool==None:
+      try: size = int(os.environ.get("LEXCONVERT_ESPEAK_POOL","") or 0)
+      except ValueError:
+         sys.stderr.write("Warning: ignoring LEXCONVERT_ESPEAK_POOL as it is not a number\n")
+         size = 0
+      espeak_pool = EspeakPool(size)
+   return espeak_pool
+
+def espeakStream(pieces,command="espeak -q -x"):
+   "Generator that starts one espeak -q -x (or command), writes each string in pieces to it (from another thread, so neither side of the pipe can fill up and block the other) and gives eSpeak's output as it arrives.  pieces can be a list or an iterator."
+   import subprocess
+   proc = subprocess.Popen(command,shell=True,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,close_fds=True)
+   def writer():
+      try:
+         for piece in pieces: proc.stdin.write(piece)
+         proc.stdin.close()
+      except IOError: pass # eSpeak stopped (or isn't installed); any message will be in its output
+   t = threading.Thread(target=writer) ; t.daemon = True ; t.start()
+   while True:
+      out = os.read(proc.stdout.fileno(),65536)
+      if not out: break
+      yield out
+   t.join() ; proc.stdout.close() ; proc.wait()
+
+def espeakWordPronunciations(words,frameSize=1000,showProgress=False,jobs=1):
+   """Returns a dictionary of each of words to what espeak -q -x -v en-rp says for it (with spaces taken out), for checking eSpeak's existing pronunciations.  All the words go through one eSpeak process which is read while it's being written to (see espeakStream), so no temporary file is needed.
+   The words are written one per line in frames of frameSize words, each frame followed by a sentinel line, so a word that doesn't come out as exactly one line can't make the other frames' words get the wrong pronunciations: such frames are done again a word at a time.
+   If jobs is more than 1, the words are split into that many shards, each going through its own eSpeak process at the same time."""
+   if jobs > 1 and len(words) > frameSize:
+      from multiprocessing.pool import ThreadPool
+      shardSize = -(-len(words)//jobs)
+      shards = [words[i:i+shardSize] for i in xrange(0,len(words),shardSize)]
+      threads = ThreadPool(jobs) ; ret = {} ; done = 0
+      try:
+         for r in threads.imap_unordered(lambda shard:espeakWordPronunciations(shard,frameSize),shards):
+            ret.update(r) ; done += 1 # (the words are all different, so it doesn't matter which shard finishes first)
+            if showProgress: sys.stdout.write(str(int(done*100/len(shards)))+"%\r") ; sys.stdout.flush()
+      finally: threads.terminate()
+      if showProgress: print
+      return ret
+   sentinel = EspeakWorker.sentinel
+   frames = [words[i:i+frameSize] for i in xrange(0,len(words),frameSize)]
+   def pieces():
+      yield sentinel+"\n" # so we know what eSpeak says for it
+      for frame in frames: yield "".join(w+"\n" for w in frame)+sentinel+"\n"
+   def lines():
+      part = ""
+      for out in espeakStream(pieces(),"espeak -q -x -v en-rp"):
+         out = (part+out).split("\n") ; part = out.pop()
+         for l in out: yield l
+      yield part
+   ret,redo,sentinelOut,got,done = {},[],None,[],0
+   frameIter = iter(frames)
+   for line in lines():
+      line = line.strip().replace(" ","")
+      if not line: continue
+      if sentinelOut==None: sentinelOut = line
+      elif line==sentinelOut:
+         frame = next(frameIter,None)
+         if frame==None: break
+         if len(got)==len(frame): ret.update(zip(frame,got))
+         elif frameSize==1: ret[frame[0]] = "".join(got)
+         else: redo += frame
+         got = [] ; done += 1
+         if showProgress: sys.stdout.write(str(int(done*100/len(frames)))+"%\r") ; sys.stdout.flush()
+      else: got.append(line)
+   for frame in frameIter: # eSpeak stopped early
+      if frameSize==1: ret[frame[0]] = "".join(got) ; got = []
+      else: redo += frame
+   if showProgress: print
+   if redo: ret.update(espeakWordPronunciations(redo,1))
+   return ret
+
+def espeakChunks(inpt,bufsize):
+   "Splits inpt into pieces of up to bufsize bytes, at newlines or spaces if possible (for espeakResponses)"
    while len(inpt) > bufsize:
       splitAt = inpt.rfind('\n',0,bufsize)+1
       if not splitAt: # no newline, try to split on space
@@ -2217,12 +2394,67 @@ def pipeThroughEspeak(inpt):
          if not splitAt:
             sys.stderr.write("Note: had to split eSpeak input and couldn't find a newline or space to do it on\n")
             splitAt = bufsize
-      response = pipeThroughEspeak(inpt[:splitAt])
-      if not '\n' in response.rstrip() and 'command' in response: return response.strip() # 'bad cmd' / 'cmd not found'
-      ret.append(response) ; inpt=inpt[splitAt:]
-   w,r=os.popen4("espeak -q -x",bufsize=bufsize)
-   w.write(inpt) ; w.close()
-   return "\n".join(ret) + r.read()
+      yield inpt[:splitAt] ; inpt=inpt[splitAt:]
+   yield inpt
+
+def espeakOneChunk(inpt):
+   "Returns eSpeak's response to inpt, from an EspeakPool worker if possible, otherwise from espeak -q -x"
+   response = get_espeak_pool().process(inpt)
+   if response==None: response = "".join(espeakStream([inpt]))
+   return response
+
+def espeakResponses(chunks):
+   "Generator giving eSpeak's response to each of chunks (an iterable of strings small enough for espeakOneChunk), in order.  If LEXCONVERT_ESPEAK_POOL is more than 1, that many chunks are run through eSpeak at once (the responses are still given in order, each as soon as it and the ones before it are ready); chunks can be a generator, as no more than twice that many are read ahead."
+   n = get_espeak_pool().size
+   if n > 1:
+      from multiprocessing.pool import ThreadPool
+      threads = ThreadPool(n) ; pending = []
+      try:
+         for chunk in chunks:
+            pending.append(threads.apply_async(espeakOneChunk,(chunk,)))
+            if len(pending) >= 2*n: yield pending.pop(0).get()
+         for p in pending: yield p.get()
+      finally: threads.terminate()
+   else:
+      for chunk in chunks: yield espeakOneChunk(chunk)
+
+def readBlocks(f,bufsize):
+   "Generator giving the text from file f in pieces of up to about bufsize bytes, split after a newline or space where possible.  A piece is given early if no more input is ready yet, so a slow pipe doesn't have to fill a whole piece before we do anything.  Memory use is limited however long the input is."
+   import select
+   fd = f.fileno() ; carry = "" ; eof = False
+   while not eof:
+      data = [carry] ; size = len(carry)
+      while size < bufsize:
+         more = os.read(fd,bufsize-size)
+         if not more:
+            eof = True ; break
+         data.append(more) ; size += len(more)
+         if not select.select([fd],[],[],0)[0]: break # nothing more ready yet
+      data = "".join(data)
+      splitAt = data.rfind('\n')+1 or data.rfind(' ')+1
+      if eof or (not splitAt and len(data) >= bufsize): splitAt = len(data)
+      carry = data[splitAt:]
+      if splitAt: yield data[:splitAt]
+
+def readRecords(f,sep,bufsize=65536):
+   "Generator giving the parts of file f that are separated by sep, like f.read().split(sep) but reading only bufsize bytes at a time"
+   part = ""
+   while True:
+      data = f.read(bufsize)
+      if not data: break
+      pieces = (part+data).split(sep)
+      part = pieces.pop()
+      for p in pieces: yield p
+   yield part
+
+def pipeThroughEspeak(inpt):
+   "Writes inpt to espeak -q -x and returns the result (if using LEXCONVERT_ESPEAK_POOL, this is done in chunks; otherwise all of inpt goes through one eSpeak process)"
+   if not get_espeak_pool().size: return "".join(espeakStream([inpt]))
+   ret = []
+   for response in espeakResponses(espeakChunks(inpt,8192)): # (EspeakWorker.process writes all of a chunk before reading, so the response must fit in the pipe)
+      if ret and not '\n' in ret[-1].rstrip() and 'command' in ret[-1]: return ret[-1].strip() # 'bad cmd' / 'cmd not found'
+      ret.append(response)
+   return "\n".join(ret[:-1]) + ret[-1]
 
 def espeak_version_line(): return os.popen("espeak -h 2>&1").read().strip().split("\n")[0]
 
@@ -2297,11 +2529,63 @@ def festival_group_stress(pronunc):
    return "("+' '.join(("(("+' '.join(g[0])+') '+g[1]+")") for g in groups)+")"
 
 def mainopt_convert(i):
-   """*<from-format> <to-format>
+   """*<from-format> <to-format> [--jobs N] [--incremental]
 Convert a user lexicon (generally from its default filename; if this cannot be found then lexconvert will tell you what it should be).
-E.g.: python lexconvert.py --convert festival cepstral"""
+E.g.: python lexconvert.py --convert festival cepstral
+For large lexicons, --jobs N converts in N processes at once (entries are still written in the original order).
+With --incremental, the conversions are also saved in a manifest file next to the lexicon, and if the lexicon has not been changed since then, the next --convert --incremental overwrites it converting only the entries that are new or changed (or all of them if lexconvert or the environment variables it uses have changed)."""
    fromFormat = sys.argv[i+1]
    toFormat = sys.argv[i+2]
+   msg = lexicon_target_problem(fromFormat,toFormat)
+   if msg: return msg
+   jobs = jobs_option()
+   done = None
+   if '--incremental' in sys.argv:
+      done = read_lexicon_manifest(getSetting(toFormat,"lex_filename"),fromFormat,toFormat)
+      if done==None: done,overwrite = {},False
+      else: overwrite = True
+   else: overwrite = False
+   fname,outFile = open_lexicon_target(toFormat,overwrite)
+   print "Writing %s lexicon entries to %s file %s" % (fromFormat,toFormat,fname)
+   try: convert_user_lexicon(fromFormat,toFormat,outFile,jobs,done)
+   except Message:
+     print " - error, deleting",fname
+     os.remove(fname) ; raise
+   if not done==None:
+      outFile.close() ; write_lexicon_manifest(fname,fromFormat,toFormat,done)
+
+def mainopt_convert_many(i):
+   """*<from-format> <to-format> [<to-format> ...]
+Like --convert but writes several lexicons at once, reading the user lexicon and splitting up its pronunciations only once for all of them.
+E.g.: python lexconvert.py --convert-many festival cepstral acapela-uk espeak unicode-ipa"""
+   fromFormat = sys.argv[i+1]
+   toFormats = sys.argv[i+2:]
+   if not toFormats: return "--convert-many needs at least one format to convert to"
+   if not len(set(toFormats))==len(toFormats): return "Please give each format only once"
+   fnames = {}
+   for toFormat in toFormats:
+      msg = lexicon_target_problem(fromFormat,toFormat) or lexicon_target_exists(toFormat) # (checking all of them before opening any, as opening eSpeak's takes out its uncommented entries)
+      if msg: return msg
+      fname = getSetting(toFormat,"lex_filename")
+      if fname in fnames: return "Can't convert to both "+fnames[fname]+" and "+toFormat+" at once, as they both write "+replHome(fname)
+      fnames[fname] = toFormat
+   targets = []
+   try:
+      for toFormat in toFormats: targets.append(open_lexicon_target(toFormat))
+      lex = read_user_lexicon(fromFormat)
+      if not type(lex)==list: lex = list(lex)
+   except:
+     for (fname,outFile),toFormat in zip(targets,toFormats):
+        outFile.close() ; remove_lexicon_target(toFormat,fname)
+     raise
+   converted = convert_to_all([[pronunc for _,pronunc in lex]],fromFormat,toFormats)
+   for (fname,outFile),(toFormat,[pronuncs]) in itertools.izip(targets,converted):
+      print "Writing %s lexicon entries to %s file %s" % (fromFormat,toFormat,fname)
+      write_lexicon(toFormat,outFile,itertools.izip((word for word,_ in lex),pronuncs))
+      outFile.close()
+
+def lexicon_target_problem(fromFormat,toFormat):
+   "Returns the reason why --convert can't write a toFormat lexicon from fromFormat, or None if it can"
    if fromFormat==toFormat: return "Cannot convert a lexicon to its own format (that could result in it being truncated)"
    if toFormat=="mac-uk": return "Cannot permanently save a Mac-UK lexicon; please use the --mac-uk option to read text"
    if toFormat=="example": return "Cannot overwrite the built-in example lexicon"
@@ -2312,36 +2596,52 @@ E.g.: python lexconvert.py --convert festival cepstral"""
       getSetting(toFormat,"lex_entry_format") # convert_user_lexicon will need this
    except KeyError: fname = None
    if not fname: return "Write support for lexicons of format '%s' not yet implemented (need at least lex_filename and lex_entry_format); try using --phones or --phones2phones options instead" % (toFormat,)
+
+def lexicon_target_exists(toFormat):
+   "Returns a message if toFormat's lexicon file already has something in it that --convert would overwrite, otherwise None"
+   if toFormat=="espeak": return # (its commented entries are kept)
+   fname=getSetting(toFormat,"lex_filename")
+   try: l = open(fname).read()
+   except: return
+   if l: return "File "+replHome(fname)+" already exists and is not empty; are you sure you want to overwrite it?  (Delete it first if so)"
+
+def remove_lexicon_target(toFormat,fname):
+   "Deletes a lexicon file that open_lexicon_target opened (putting back eSpeak's old en_extra), when we can't finish writing it"
+   if toFormat=="espeak" and os.path.exists(fname+"~"):
+      print " - error, putting back",fname
+      os.rename(fname+"~",fname)
+   else:
+      print " - error, deleting",fname
+      os.remove(fname)
+
+def open_lexicon_target(toFormat,overwrite=False):
+   "Opens toFormat's lexicon file for --convert and returns (filename,file).  Unless overwrite is True, the file must not already have anything in it (except for eSpeak, where its commented entries are kept)."
+   fname=getSetting(toFormat,"lex_filename")
    if toFormat=="espeak":
       assert fname=="en_extra", "If you changed eSpeak's lex_filename in the table you also need to change the code below"
       if os.system("mv en_extra en_extra~ && grep \" // \" en_extra~ > en_extra"): sys.stderr.write("Warning: en_extra not found, making a new one\n(espeak compile will probably fail in this directory)\n") # otherwise keep the commented entries, so can incrementally update the user lexicon only
       outFile=open(fname,"a")
    else:
-      l = 0
-      try: l = open(fname).read()
-      except: pass
-      assert not l, "File "+replHome(fname)+" already exists and is not empty; are you sure you want to overwrite it?  (Delete it first if so)" # (if you run with python -O then this is ignored, as are some other checks so be careful)
+      if not overwrite:
+        problem = lexicon_target_exists(toFormat)
+        assert not problem, problem # (if you run with python -O then this is ignored, as are some other checks so be careful)
       outFile=open(fname,"w")
-   print "Writing %s lexicon entries to %s file %s" % (fromFormat,toFormat,fname)
-   try: convert_user_lexicon(fromFormat,toFormat,outFile)
-   except Message:
-     print " - error, deleting",fname
-     os.remove(fname) ; raise
+   return fname,outFile
 
 def mainopt_festival_dictionary_to_espeak(i):
-   """<location>
+   """<location> [--jobs N]
 Convert the Festival Oxford Advanced Learners Dictionary (OALD) pronunciation lexicon to eSpeak.
 You need to specify the location of the OALD file in <location>,
 e.g. for Debian festlex-oald package: python lexconvert.py --festival-dictionary-to-espeak /usr/share/festival/dicts/oald/all.scm
 or if you can't install the Debian package, try downloading http://ftp.debian.org/debian/pool/non-free/f/festlex-oald/festlex-oald_1.4.0.orig.tar.gz, unpack it into /tmp, and do: python lexconvert.py --festival-dictionary-to-espeak /tmp/festival/lib/dicts/oald/oald-0.4.out
-In all cases you need to cd to the eSpeak source directory before running this.  en_extra will be overwritten.  Converter will also read your ~/.festivalrc if it exists.  (You can later incrementally update from ~/.festivalrc using the --convert option; the entries from the system dictionary will not be overwritten in this case.)  Specify --without-check to bypass checking the existing eSpeak pronunciation for OALD entries (much faster, but makes a larger file and in some cases compromises the pronunciation quality)."""
+In all cases you need to cd to the eSpeak source directory before running this.  en_extra will be overwritten.  Converter will also read your ~/.festivalrc if it exists.  (You can later incrementally update from ~/.festivalrc using the --convert option; the entries from the system dictionary will not be overwritten in this case.)  Specify --without-check to bypass checking the existing eSpeak pronunciation for OALD entries (much faster, but makes a larger file and in some cases compromises the pronunciation quality).  Specify --jobs N to do the checking in N eSpeak processes at once (and convert ~/.festivalrc in N processes)."""
    try: festival_location=sys.argv[i+1]
    except IndexError: return "Error: --festival-dictionary-to-espeak must be followed by the location of the festival OALD file (see help text)"
    try: open(festival_location)
    except: return "Error: The specified OALD location '"+festival_location+"' could not be opened"
    try: open("en_list")
    except: return "Error: en_list could not be opened (did you remember to cd to the eSpeak dictsource directory first?"
-   convert_system_festival_dictionary_to_espeak(festival_location,not '--without-check' in sys.argv,not os.system("test -e ~/.festivalrc"))
+   convert_system_festival_dictionary_to_espeak(festival_location,not '--without-check' in sys.argv,not os.system("test -e ~/.festivalrc"),jobs_option())
 
 def mainopt_syllables(i):
    """[<words>]
@@ -2361,39 +2661,57 @@ def wordSeparator(format):
 
 def mainopt_phones2phones(i):
    """*<format1> <format2> [<phonemes in format1>]
-Perform a one-off conversion of phonemes from format1 to format2 (format2 can be 'all' if you want)""" # If format1 is 'example' and you don't specify phonemes, we take the words from the example lexicon.  But don't say that in the help string because it might confuse the issue about phonemes being optional on the command line and prompted for if not specified and stdin is not piped in all formats other than 'example'.
+Perform a one-off conversion of phonemes from format1 to format2 (format2 can be 'all' if you want)
+Conversions of words are cached (here and in --phones and --convert).  Set environment variable LEXCONVERT_CACHE_SIZE to the number of words to keep (default 20000, or 0 to turn the cache off), and set LEXCONVERT_CACHE_STATS to see how well it did (on standard error).""" # If format1 is 'example' and you don't specify phonemes, we take the words from the example lexicon.  But don't say that in the help string because it might confuse the issue about phonemes being optional on the command line and prompted for if not specified and stdin is not piped in all formats other than 'example'.
    format1,format2 = sys.argv[i+1],sys.argv[i+2]
    if not format1 in lexFormats: return "No such format "+repr(format1)+" (use --formats to see a list of formats)"
    if not format2 in lexFormats and not format2=="all": return "No such format "+repr(format2)+" (use --formats to see a list of formats)"
    if format1=="example" and len(sys.argv)<=i+3:
      if stdin_is_terminal(): txt=""
      else: txt=sys.stdin.read() # and it might still be ""
-     if txt: parseIntoWordsAndClauses(format1,txt)
+     if txt: clauses = parseIntoWordsAndClauses(format1,txt)
      else: clauses=[[x[1]] for x in getSetting('example','lex_read_function')()]
+   elif not format2=="all" and not ' '.join(sys.argv[i+3:]) and not stdin_is_terminal(): clauses = iterClauses(format1,readBlocks(sys.stdin,65536)) # piped input: convert and write a clause at a time
    else: clauses = parseIntoWordsAndClauses(format1,getInputText(i+3,"phonemes in "+format1+" format"))
    if format2=="all": formats = sorted(k for k in lexFormats.keys() if not k=="example")
    else: formats = [format2]
-   for format2 in formats:
+   if len(formats)==1: converted = [(format2,convert_batch(clauses,format1,format2))] # (clauses might be a generator)
+   else: converted = convert_to_all(clauses,format1,formats)
+   for format2,clauses2 in converted:
      if len(formats)>1: writeFormatHeader(format2)
      sys.stdout.write(checkSetting(format2,"inline_header"))
-     output_clauses(format2,convert(clauses,format1,format2))
+     output_clauses(format2,clauses2)
      sys.stdout.write(checkSetting(format2,"inline_footer")) ; print
 
 def parseIntoWordsAndClauses(format,phones):
    "Returns list of clauses, each of which is a list of words, assuming 'phones' are in format 'format'"
+   return list(iterClauses(format,phones))
+
+def iterClauses(format,phones):
+   "Generator version of parseIntoWordsAndClauses.  phones can also be an iterable of strings (e.g. from readBlocks), in which case each clause is given as soon as it's complete, and only one clause is held in memory at a time."
    wordSep = checkSetting(format,"word_separator") # don't use wordSeparator() here - we're splitting, not joining, so we don't want it to default to phoneme_separator
    clauseSep = checkSetting(format,"clause_separator","\n")
-   def s(sep):
-      if sep==" ": return None # " " means ANY whitespace (TODO: document this?)
-      else: return sep
-   if clauseSep and type(clauseSep) in [str,unicode]:
-      clauses = phones.split(s(clauseSep))
-   else: clauses = [phones]
-   for i in range(len(clauses)):
-      if wordSep: clauses[i]=clauses[i].split(s(wordSep))
-      else: clauses[i] = [clauses[i]]
-      clauses[i] = filter(lambda x:x, clauses[i])
-   return filter(lambda x:x,clauses)
+   def split(text,sep):
+      if sep==" ": # " " means ANY whitespace (TODO: document this?)
+         words = text.split() # (as before, so only ASCII whitespace in a byte string, not the \xa0 and \x85 bytes inside UTF-8 characters)
+         if not text or text[-1].isspace(): words.append("") # (split() loses any whitespace at the end, which matters when a clause continues in the next string)
+         return words
+      else: return text.split(sep)
+   if type(phones) in [str,unicode]: phones = [phones]
+   def clauses():
+      if clauseSep and type(clauseSep) in [str,unicode]:
+         carry = ""
+         for text in phones:
+            c = split(carry+text,clauseSep)
+            carry = c.pop()
+            for clause in c: yield clause
+         yield carry
+      else: yield "".join(phones)
+   for clause in clauses():
+      if wordSep: clause = split(clause,wordSep)
+      else: clause = [clause]
+      clause = filter(lambda x:x, clause)
+      if clause: yield clause
 
 def mainopt_mac_uk(i):
    """<from-format> [<text>]
@@ -2434,9 +2752,11 @@ def variant():
     # the 0 is so we can say _, name = variant()
     # so as to get some extra indentation
 
+ifset_vars = set(["KANA_TYPE"]) # environment variables that conversion results depend on (KANA_TYPE is read directly by hiragana_to_katakana); ifset adds the others
 def ifset(var,a,b=""):
    "Checks the environment variable var; if it is set (non-empty), return a, otherwise return b.  Used in LexFormats to create tables with variations set by the environment."
    import os
+   ifset_vars.add(var)
    if os.environ.get(var,""): return a
    else: return b
 
@@ -2448,7 +2768,12 @@ def speakjet(symbol,opcode):
    else: return ifset('SPEAKJET_SYM',symbol,str(opcode))
 
 def makeDic(doc,*args,**kwargs):
-    "Make a dictionary with a doc string, default-bidirectional mappings and extra settings; see LexFormats for how this is used."
+    "Make a dictionary with a doc string, default-bidirectional mappings and extra settings; see LexFormats for how this is used.  The dictionary is made when it's first needed (returns a LazyDic)."
+    global lastDictionaryMade
+    lastDictionaryMade = LazyDic(lambda:buildDic(doc,args,kwargs))
+    return lastDictionaryMade
+def buildDic(doc,args,kwargs,checkMissing=True):
+    "Does the work of makeDic (checkMissing is False when called from makeVariantDic, so it doesn't complain if some vowels/consonants are missing)"
     assert type(doc)==str, "doc must be a string"
     d = {} ; duplicates = set()
     for a in args:
@@ -2465,7 +2790,8 @@ def makeDic(doc,*args,**kwargs):
             if v in d: duplicates.add(v)
             d[v] = k
     assert not duplicates, " Duplicate key(s) in "+repr(doc)+": "+", ".join((repr(dup)+"".join(" (="+g+")" for g,val in globals().items() if val==dup)) for dup in sorted(list(duplicates)))+". Did you forget a ,False to suppress bidirectional mapping?" # by the way, Python does not detect duplicate keys in {...} notation - it just lets you overwrite
-    missing = [l for l in (list(consonants)+list(mainVowels)) if not l in d]
+    if checkMissing: missing = [l for l in (list(consonants)+list(mainVowels)) if not l in d]
+    else: missing = []
     # did_approx = False
     if missing and 'approximate_missing' in kwargs:
       for miss,approxTo in [
@@ -2492,27 +2818,22 @@ def makeDic(doc,*args,**kwargs):
     psep = d.get(('settings','phoneme_separator'),' ')
     if not wsep==None: assert not wsep in d, "word_separator duplicates with a key in "+repr(doc)
     if not psep==None: assert not psep in d, "phoneme_separator duplicates with a key (did you forget to change the default, or to add a ,False somewhere?) in "+repr(doc)
-    global lastDictionaryMade ; lastDictionaryMade = d
     return d
 def makeVariantDic(doc,*args,**kwargs):
     "Like makeDic but create a new 'variant' version of the last-made dictionary, modifying some phonemes and settings (and giving it a new doc string) but keeping everything else the same.  Any list settings (e.g. cleanup_regexps) are ADDED to by the variant; other settings and phonemes are REPLACED if they are specified in the variant.  If you don't want subsequent variants to inherit the changes made by this variant, add noInherit=True to the keyword args."
     global lastDictionaryMade
-    ldmOld = lastDictionaryMade
-    toUpdate = lastDictionaryMade.copy()
-    global mainVowels,consonants
-    oldV,oldC = mainVowels,consonants
-    mainVowels,consonants = [],[] # so makeDic doesn't complain if some vowels/consonants are missing
-    if 'noInherit' in kwargs:
-       noInherit = kwargs['noInherit']
-       del kwargs['noInherit']
-    else: noInherit = False
-    d = makeDic(doc,*args,**kwargs)
-    if noInherit: lastDictionaryMade = ldmOld
-    mainVowels,consonants = oldV,oldC
-    # if toUpdate[("settings","doc")].startswith("(approx.) ") and not d[("settings","doc")].startswith("(approx.) "): d[("settings","doc")]="(approx.) "+d[("settings","doc")] # TODO: always?
-    for k,v in toUpdate.items():
-       if type(v)==list and k in d: d[k] = v+d[k]
-    toUpdate.update(d) ; return toUpdate
+    base = lastDictionaryMade # (the one we're a variant of is decided now, even though neither is made until needed)
+    noInherit = kwargs.pop('noInherit',False)
+    ownPart = LazyDic(lambda:buildDic(doc,args,kwargs,False))
+    if not noInherit: lastDictionaryMade = ownPart # (as before, a subsequent variant inherits only the settings given here, so it's usual to set noInherit)
+    def build():
+      toUpdate = base.build().copy()
+      d = ownPart.build()
+      # if toUpdate[("settings","doc")].startswith("(approx.) ") and not d[("settings","doc")].startswith("(approx.) "): d[("settings","doc")]="(approx.) "+d[("settings","doc")] # TODO: always?
+      for k,v in toUpdate.items():
+         if type(v)==list and k in d and not k[0]=='compiled': d[k] = v+d[k]
+      toUpdate.update(d) ; return toUpdate
+    return LazyDic(build)
 def getSetting(formatName,settingName):
   "Gets a setting from lexFormats, exception if not there"
   return lexFormats[formatName][('settings',settingName)]
@@ -2520,96 +2841,407 @@ def checkSetting(formatName,settingName,default=""):
   "Gets a setting from lexFormats, default if not there"
   return lexFormats[formatName].get(('settings',settingName),default)
 
-import commands,sys,re,os
+def compile_regexps(regexps):
+  """Compiles a cleanup_regexps or cvtOut_regexps list into a list of (compiled regexp, replacement) to be applied in turn with the regexp's sub method (LexFormats does this for every format, so convert doesn't have to rely on the re module's small cache of compiled expressions).
+  Runs of plain-string (search,replace) pairs are fused into a single alternation that does the whole run in one pass, but only when that is sure to give the same result as doing them one at a time: no search string may overlap another, and no replacement may contain a character that a later search string uses (so it can't create a new match)."""
+  def isPlain(search,replace): return search and replace and not re.search(r"[][.^$*+?{}|()\\]",search) and not "\\" in replace
+  def canJoin(group,search,replace):
+    for s,r in group:
+      if not (type(s)==type(r)==type(search)==type(replace)): return False
+      if s in search or search in s: return False
+      if any(s.endswith(search[:i]) or search.endswith(s[:i]) for i in xrange(1,min(len(s),len(search)))): return False
+      if any(c in search for c in r): return False
+    return True
+  ret = [] ; group = []
+  def endGroup():
+    if len(group)==1: ret.append((re.compile(group[0][0]),group[0][1]))
+    elif group:
+      table = dict(group)
+      ret.append((re.compile("|".join(re.escape(s) for s,r in group)),lambda m:table[m.group()]))
+    del group[:]
+  for search,replace in regexps:
+    if isPlain(search,replace):
+      if not canJoin(group,search,replace): endGroup()
+      group.append((search,replace))
+    else:
+      endGroup() ; ret.append((re.compile(search),replace))
+  endGroup() ; return ret
+
+import sys,re,os,itertools,threading,marshal,array
+
+class LazyDic(object):
+    "A format's table that is not made until it is first needed (saves startup time when only one or two formats are used).  makeDic and makeVariantDic return these; LazyFormats calls build()."
+    lock = threading.RLock() # (re-entrant because building a variant builds the dictionary it's a variant of)
+    def __init__(self,builder): self.builder,self.dic = builder,None
+    def build(self):
+        "Returns the table, making it (and compiling its regexps) if this hasn't been done already"
+        if self.dic is None:
+          with LazyDic.lock:
+            if self.dic is None:
+              dic = self.builder()
+              for setting in ['cleanup_regexps','cvtOut_regexps']:
+                dic[('compiled',setting)] = compile_regexps(dic.get(('settings',setting),[]))
+              self.dic,self.builder = dic,None
+        return self.dic
+
+class LazyFormats(object):
+    "Maps format names to their tables like a read-only dictionary, but makes each table when it is first looked up (see LazyDic)"
+    def __init__(self,lazyDics): self.lazyDics = lazyDics
+    def __getitem__(self,k): return self.lazyDics[k].build()
+    def __contains__(self,k): return k in self.lazyDics
+    def __iter__(self): return iter(self.lazyDics)
+    def __len__(self): return len(self.lazyDics)
+    def keys(self): return self.lazyDics.keys()
+    def values(self): return [self[k] for k in self.lazyDics]
+    def items(self): return [(k,self[k]) for k in self.lazyDics]
+    def get(self,k,default=None):
+        if k in self.lazyDics: return self[k]
+        return default
+
+class LRUCache(object):
+    "A dictionary of bounded size that counts its hits and misses (used by get_converter and memo_convert).  When it gets full, the least-recently-used quarter of its entries are forgotten (doing them in a batch keeps this cheap for large caches).  Safe to use from several threads."
+    def __init__(self,size):
+        self.size = size ; self.d = {} # key -> (value,time of last use)
+        self.clock = itertools.count()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+    def get(self,key,default=None):
+        try: value = self.d[key][0]
+        except KeyError:
+            self.misses += 1 ; return default
+        self.d[key] = (value,self.clock.next()) ; self.hits += 1
+        return value
+    def put(self,key,value):
+        self.d[key] = (value,self.clock.next())
+        if len(self.d) > self.size:
+          with self.lock:
+            byAge = sorted((t,k) for k,(v,t) in self.d.items())
+            for t,k in byAge[:len(byAge)-self.size*3/4]: self.d.pop(k,None)
+    def __len__(self): return len(self.d)
+    def stats(self):
+        "Returns a summary of the hit/miss counters, for diagnostics"
+        total = self.hits+self.misses
+        if total: rate = " (%d%% hits)" % (self.hits*100/total)
+        else: rate = ""
+        return "%d hits, %d misses%s, %d of %d entries used" % (self.hits,self.misses,rate,len(self.d),self.size)
+
+class Converter(object):
+    """Converts pronunciations from one particular source format to one particular dest format, using mapping tables made from lexFormats when the Converter is created.  A Converter is never changed after it has been made, so it can be shared between threads (e.g. in a multithreaded server); use get_converter to fetch one from the cache.  sourceName can be None for converting from phoneme IDs (see render)."""
+    def __init__(self,sourceName,destName):
+        if sourceName==None: source = id_settings # converting from phoneme IDs (see render)
+        else: source = lexFormats[sourceName]
+        dest = lexFormats[destName]
+        d = {}
+        dest_consonants = set()
+        implicit_vowel_before_NL = None
+        if sourceName: toCheck = source.items()
+        else: toCheck = [(k,k) for k in dest.keys() if type(k) in [int,float]]
+        for k,v in toCheck:
+          if type(k)==tuple: continue # settings
+          if type(v) in [str,unicode]: continue # (num->string entries are for converting IN to source; we want the string->num entries for converting out)
+          if not v in dest: v = int(v) # (try the main version of a variant)
+          if not v in dest: continue # (haven't got it - will have to ignore or break into parts)
+          d[k] = dest[v]
+          if int(v) in consonants: dest_consonants.add(d[k])
+          if int(v)==e_as_in_herd and (not implicit_vowel_before_NL or v==int(v)): # TODO: or u_as_in_but ?  used by festival and some other synths before words ending 'n' or 'l' (see usage of implicit_vowel_before_NL later)
+            implicit_vowel_before_NL = d[k]
+        self.__dict__.update({
+          # Everything convert() needs is worked out here, once per (source,dest) pair, rather than once per word:
+          "sourceName":sourceName, "destName":destName,
+          "dictionary":d, "trie":sourceName and make_trie(d), # (the trie also takes care of the maximum key length)
+          "dest_consonants":frozenset(dest_consonants),
+          "dest_syllable_sep":dest.get(syllable_separator,""),
+          "dest_stress_marks":frozenset(m for m in [dest.get(primary_stress,''),dest.get(secondary_stress,'')] if m),
+          "implicit_vowel_before_NL":implicit_vowel_before_NL,
+          "separator":dest.get(('settings','phoneme_separator'),' '),
+          "safe_to_drop":source.get(('settings','safe_to_drop_characters'),""),
+          "source_stress_before":source.get(('settings','stress_comes_before_vowel'),""),
+          "dest_stress_before":dest.get(('settings','stress_comes_before_vowel'),""),
+          "cvtOut_func":source.get(('settings','cvtOut_func'),""),
+          "cvtOut_regexps":source[('compiled','cvtOut_regexps')],
+          "cleanup_regexps":dest[('compiled','cleanup_regexps')],
+          "cleanup_func":dest.get(('settings','cleanup_func'),"")})
+    def __setattr__(self,name,value): raise AttributeError("Converter objects cannot be changed (make a new one instead)")
+    def convert(self,pronunc):
+        "Convert the string pronunc (see also the convert function, which can take lists)"
+        return self.render(self.split(pronunc))
+    def split(self,pronunc):
+        "Generator giving the dest phoneme strings for the source phonemes in pronunc (after the source's cvtOut settings), using the longest match each time.  Source characters that can't be matched are dropped (with a warning unless safe_to_drop_characters says otherwise)."
+        if self.cvtOut_func: pronunc=self.cvtOut_func(pronunc)
+        for s,r in self.cvtOut_regexps:
+            pronunc=s.sub(r,pronunc)
+        trie,safe_to_drop = self.trie,self.safe_to_drop
+        debugInfo=""
+        i = 0 ; pLen = len(pronunc)
+        while i < pLen:
+            # walk the trie from i to find the longest key that matches there (as in longest_match, but inline for speed)
+            node,match,j = trie,None,i
+            while j < pLen:
+                node = node.get(pronunc[j])
+                if node is None: break
+                j += 1
+                if None in node: match = node[None]
+            if not match:
+                if safe_to_drop==True: pass
+                elif (not safe_to_drop) or not pronunc[i] in safe_to_drop and not (pronunc[i],debugInfo) in warnedAlready:
+                    warnedAlready.add((pronunc[i],debugInfo))
+                    sys.stderr.write("Warning: ignoring "+self.sourceName+" character "+repr(pronunc[i])+debugInfo+" (unsupported in "+self.destName+")\n")
+                i += 1 ; continue # ignore
+            key,toAdd = match
+            debugInfo=" after "+key
+            yield toAdd ; i += len(key)
+    def render(self,phones):
+        "Makes the dest pronunciation from an iterable of dest phoneme strings (as given by split), moving stress marks, adding implicit vowels, joining with the phoneme separator and doing the dest's cleanup"
+        ret = [] ; toAddAfter = None
+        dest_consonants,dest_syllable_sep,dest_stress_marks,implicit_vowel_before_NL,separator = self.dest_consonants,self.dest_syllable_sep,self.dest_stress_marks,self.implicit_vowel_before_NL,self.separator
+        for toAdd in phones:
+            isStressMark=(toAdd in dest_stress_marks)
+            if toAdd==dest_syllable_sep: pass
+            elif isStressMark and not self.dest_stress_before:
+                if self.source_stress_before: toAdd, toAddAfter = "",toAdd # move stress marks from before vowel to after
+                else: # stress is already after, but:
+                    # With Cepstral synth (and kana-approx), stress mark should be placed EXACTLY after the vowel and not any later.  Might as well do this for others also.
+                    r=len(ret)-1
+                    while ret[r] in dest_consonants or ret[r].endswith("*added"): r -= 1 # (if that raises IndexError then the input had a stress mark before any vowel) ("*added" condition is there so that implicit vowels don't get the stress)
+                    ret.insert(r+1,toAdd) ; toAdd=""
+            elif isStressMark and not self.source_stress_before: # it's a stress mark that should be moved from after the vowel to before it
+                r=len(ret)
+                while r and (ret[r-1] in dest_consonants or ret[r-1].endswith("*added")): r -= 1
+                if r: r-=1
+                ret.insert(r,toAdd)
+                if dest_syllable_sep: ret.append(dest_syllable_sep) # (TODO: this assumes stress marks are at end of syllable rather than immediately after vowel; correct for Festival; check others; probably a harmless assumption though; mac-uk is better with syllable separators although espeak basically ignores them)
+                toAdd = ""
+            # attempt to sort out the festival dictionary's (and other's) implicit_vowel_before_NL
+            elif implicit_vowel_before_NL and ret and ret[-1] and toAdd in ['n','l'] and ret[-1] in dest_consonants: ret.append(implicit_vowel_before_NL+'*added')
+            elif len(ret)>2 and ret[-2].endswith('*added') and toAdd and not toAdd in dest_consonants and not toAdd==dest_syllable_sep: del ret[-2]
+            if toAdd:
+                # Add it, but if toAdd is multiple phonemes, try to put toAddAfter after the FIRST phoneme
+                if separator: toAdd=toAdd.split(separator)
+                else: toAdd = [toAdd] # TODO: won't work for formats that don't have a phoneme separator (doesn't really matter for eSpeak though)
+                ret.append(toAdd[0])
+                if toAddAfter and not toAdd[0] in dest_consonants:
+                    ret.append(toAddAfter)
+                    toAddAfter=None
+                ret += toAdd[1:]
+        if toAddAfter: ret.append(toAddAfter)
+        if ret and ret[-1]==dest_syllable_sep: del ret[-1] # spurious syllable separator at end
+        ret=separator.join(ret).replace('*added','')
+        for s,r in self.cleanup_regexps:
+          ret=s.sub(r,ret)
+        if self.cleanup_func: return self.cleanup_func(ret)
+        else: return ret
+
+converter_cache = LRUCache(64) # (sourceName,destName) -> Converter; 64 is enough for --phones all
+def get_converter(sourceName,destName):
+    "Returns a Converter from sourceName to destName, re-using a recently-made one if possible (converter_cache.hits and .misses count how often that happens)"
+    c = converter_cache.get((sourceName,destName))
+    if not c:
+      c = Converter(sourceName,destName)
+      converter_cache.put((sourceName,destName),c) # (if two threads get here at once, they both make one, which is harmless)
+    return c
+
+def env_signature():
+    "Returns the current values of the environment variables in ifset_vars, for checking cached results are still valid"
+    return tuple(os.environ.get(v,"") for v in sorted(ifset_vars))
+
+try: word_cache_size = int(os.environ.get("LEXCONVERT_CACHE_SIZE","") or 20000)
+except ValueError:
+    sys.stderr.write("Warning: ignoring LEXCONVERT_CACHE_SIZE as it is not a number\n")
+    word_cache_size = 20000
+word_cache = LRUCache(word_cache_size) # (pronunc,type,sourceName,destName) -> result; set LEXCONVERT_CACHE_SIZE=0 to turn off (see --phones2phones help)
+word_cache.env = None
+def check_word_cache():
+    "Clears word_cache if the environment has changed since it was last checked.  Called once per convert or convert_batch call (not per word, as reading the environment costs more than the conversion)."
+    env = env_signature()
+    if not env==word_cache.env:
+      with word_cache.lock: word_cache.d.clear() # environment changed, so old results might be wrong
+      word_cache.env = env
+def memo_convert(converter,pronunc):
+    "Calls converter.convert(pronunc), re-using the result from word_cache if this word has been converted before (call check_word_cache first)"
+    if not word_cache.size: return converter.convert(pronunc)
+    key = (pronunc,type(pronunc),converter.sourceName,converter.destName) # (type is there because u"x"==str "x" but the results could differ)
+    r = word_cache.get(key)
+    if r is None:
+      r = converter.convert(pronunc)
+      word_cache.put(key,r)
+    return r
+
+def cache_stats():
+    "Returns a summary of how well converter_cache and word_cache are doing (printed to standard error after the command if LEXCONVERT_CACHE_STATS is set)"
+    return "Converter cache: "+converter_cache.stats()+"\nWord cache: "+word_cache.stats()
 
-cached_sourceName,cached_destName,cached_dict = None,None,None
 def make_dictionary(sourceName,destName):
-    "Uses lexFormats to make a mapping dictionary from a particular source format to a particular dest format, and also sets module variables for that particular conversion (TODO: put those module vars into an object in case someone wants to use this code in a multithreaded server)"
-    global cached_sourceName,cached_destName,cached_dict
-    if (sourceName,destName) == (cached_sourceName,cached_destName): return cached_dict
-    source = lexFormats[sourceName]
-    dest = lexFormats[destName]
-    d = {}
-    global dest_consonants ; dest_consonants = set()
-    global dest_syllable_sep ; dest_syllable_sep = dest.get(syllable_separator,"")
-    global implicit_vowel_before_NL
-    implicit_vowel_before_NL = None
-    for k,v in source.items():
-      if type(k)==tuple: continue # settings
-      if type(v) in [str,unicode]: continue # (num->string entries are for converting IN to source; we want the string->num entries for converting out)
-      if not v in dest: v = int(v) # (try the main version of a variant)
-      if not v in dest: continue # (haven't got it - will have to ignore or break into parts)
-      d[k] = dest[v]
-      if int(v) in consonants: dest_consonants.add(d[k])
-      if int(v)==e_as_in_herd and (not implicit_vowel_before_NL or v==int(v)): # TODO: or u_as_in_but ?  used by festival and some other synths before words ending 'n' or 'l' (see usage of implicit_vowel_before_NL later)
-        implicit_vowel_before_NL = d[k]
-    cached_sourceName,cached_destName,cached_dict=sourceName,destName,d
-    return d
+    "Uses lexFormats to make a mapping dictionary from a particular source format to a particular dest format (kept for compatibility; the other per-conversion values are now in the Converter object from get_converter)"
+    return get_converter(sourceName,destName).dictionary
+
+def make_trie(dictionary):
+    "Compiles a mapping dictionary (see Converter) into a prefix trie for the longest-match tokeniser.  Each node is a dict from one character to the next node, and a node that completes a key of the dictionary also has that key's (key,value) stored under None."
+    trie = {}
+    for k,v in dictionary.items():
+        node = trie
+        for c in k: node = node.setdefault(c,{})
+        node[None] = (k,v)
+    return trie
+def longest_match(trie,text,i):
+    "Returns the (key,value) from trie (see make_trie) for the longest key that text has at position i, or None if there isn't one"
+    node,match,pLen = trie,None,len(text)
+    while i < pLen:
+        node = node.get(text[i])
+        if node is None: break
+        i += 1
+        if None in node: match = node[None]
+    return match
 
 warnedAlready = set()
 def convert(pronunc,source,dest):
     "Convert pronunc from source to dest.  pronunc can be a string or a list; if a list then we'll recurse on each of the list elements and return a new list (this is meant for batch-converting clauses etc)"
     if source==dest: return pronunc # essential for --try experimentation with codes not yet supported by lexconvert
-    if type(pronunc)==list: return [convert(p,source,dest) for p in pronunc]
-    func = checkSetting(source,'cvtOut_func')
-    if func: pronunc=func(pronunc)
-    for s,r in checkSetting(source,'cvtOut_regexps'):
-        pronunc=re.sub(s,r,pronunc)
-    ret = [] ; toAddAfter = None
-    dictionary = make_dictionary(source,dest)
-    maxLen=max(len(l) for l in dictionary.keys())
-    debugInfo=""
-    separator = checkSetting(dest,'phoneme_separator',' ')
-    safe_to_drop = checkSetting(source,"safe_to_drop_characters")
-    while pronunc:
-        for lettersToTry in range(maxLen,-1,-1):
-            if not lettersToTry:
-              if safe_to_drop==True: pass
-              elif (not safe_to_drop) or not pronunc[0] in safe_to_drop and not (pronunc[0],debugInfo) in warnedAlready:
-                 warnedAlready.add((pronunc[0],debugInfo))
-                 sys.stderr.write("Warning: ignoring "+source+" character "+repr(pronunc[0])+debugInfo+" (unsupported in "+dest+")\n")
-              pronunc=pronunc[1:] # ignore
-            elif dictionary.has_key(pronunc[:lettersToTry]):
-                debugInfo=" after "+pronunc[:lettersToTry]
-                toAdd=dictionary[pronunc[:lettersToTry]]
-                isStressMark=(toAdd and toAdd in [lexFormats[dest].get(primary_stress,''),lexFormats[dest].get(secondary_stress,'')])
-                if toAdd==lexFormats[dest].get(syllable_separator,''): pass
-                elif isStressMark and not checkSetting(dest,"stress_comes_before_vowel"):
-                    if checkSetting(source,"stress_comes_before_vowel"): toAdd, toAddAfter = "",toAdd # move stress marks from before vowel to after
-                    else: # stress is already after, but:
-                        # With Cepstral synth (and kana-approx), stress mark should be placed EXACTLY after the vowel and not any later.  Might as well do this for others also.
-                        r=len(ret)-1
-                        while ret[r] in dest_consonants or ret[r].endswith("*added"): r -= 1 # (if that raises IndexError then the input had a stress mark before any vowel) ("*added" condition is there so that implicit vowels don't get the stress)
-                        ret.insert(r+1,toAdd) ; toAdd=""
-                elif isStressMark and not checkSetting(source,"stress_comes_before_vowel"): # it's a stress mark that should be moved from after the vowel to before it
-                    i=len(ret)
-                    while i and (ret[i-1] in dest_consonants or ret[i-1].endswith("*added")): i -= 1
-                    if i: i-=1
-                    ret.insert(i,toAdd)
-                    if dest_syllable_sep: ret.append(dest_syllable_sep) # (TODO: this assumes stress marks are at end of syllable rather than immediately after vowel; correct for Festival; check others; probably a harmless assumption though; mac-uk is better with syllable separators although espeak basically ignores them)
-                    toAdd = ""
-                # attempt to sort out the festival dictionary's (and other's) implicit_vowel_before_NL
-                elif implicit_vowel_before_NL and ret and ret[-1] and toAdd in ['n','l'] and ret[-1] in dest_consonants: ret.append(implicit_vowel_before_NL+'*added')
-                elif len(ret)>2 and ret[-2].endswith('*added') and toAdd and not toAdd in dest_consonants and not toAdd==dest_syllable_sep: del ret[-2]
-                if toAdd:
-                    # Add it, but if toAdd is multiple phonemes, try to put toAddAfter after the FIRST phoneme
-                    if separator: toAdd=toAdd.split(separator)
-                    else: toAdd = [toAdd] # TODO: won't work for formats that don't have a phoneme separator (doesn't really matter for eSpeak though)
-                    ret.append(toAdd[0])
-                    if toAddAfter and not toAdd[0] in dest_consonants:
-                        ret.append(toAddAfter)
-                        toAddAfter=None
-                    ret += toAdd[1:]
-                pronunc=pronunc[lettersToTry:]
-                break
-    if toAddAfter: ret.append(toAddAfter)
-    if ret and ret[-1]==dest_syllable_sep: del ret[-1] # spurious syllable separator at end
-    ret=separator.join(ret).replace('*added','')
-    for s,r in checkSetting(dest,'cleanup_regexps'):
-      ret=re.sub(s,r,ret)
-    func = checkSetting(dest,'cleanup_func')
-    if func: return func(ret)
-    else: return ret
+    if type(pronunc)==list: return list(convert_batch(pronunc,source,dest))
+    check_word_cache()
+    return memo_convert(get_converter(source,dest),pronunc)
+
+def convert_batch(words,source,dest,jobs=1):
+    """Generator that converts each item of the iterable words from source to dest and yields the results in order, fetching the Converter only once for the whole batch.  Items that are lists are converted recursively (and yielded as lists, as in convert).  Repeats within the batch (real text has a lot of "the", "a", "of" etc) are converted only once.
+    If jobs is more than 1, the words are shared out between that many processes (see convert_in_processes); words is then read from another thread, so it must not be shared with anything else (e.g. through itertools.tee)."""
+    if source==dest:
+        for w in words: yield w
+        return
+    c = get_converter(source,dest)
+    if jobs > 1:
+        for _,r in convert_in_processes(((None,w) for w in words),source,dest,jobs): yield r
+        return
+    check_word_cache()
+    done = {}
+    def batch(words):
+        for w in words:
+            if type(w)==list: yield list(batch(w))
+            elif w in done: yield done[w]
+            else:
+                if len(done) >= 10000: done.clear() # words might be a long-running generator (see iterClauses), so don't let this grow without limit
+                r = done[w] = memo_convert(c,w)
+                yield r
+    for r in batch(words): yield r
+
+def convert_job(args):
+    "Used by convert_in_processes (in the worker processes)"
+    entries,source,dest = args
+    return zip((key for key,_ in entries),convert_batch([p for _,p in entries],source,dest))
+def convert_in_processes(entries,source,dest,jobs,chunkSize=1000):
+    """Generator that converts the second item of each (key,pronunciation) in the iterable entries from source to dest, sharing out the work between jobs processes chunkSize entries at a time, and gives (key,converted pronunciation) in the original order.  The keys (e.g. lexicon words) go to the processes and back with their pronunciations, so entries is read only by the pool's task thread.  The processes are forked after the Converter is made, so they don't have to make their own tables (but they do each keep their own caches, and might each give the same warning)."""
+    import multiprocessing
+    get_converter(source,dest)
+    def chunks():
+        entries2 = iter(entries)
+        while True:
+            chunk = list(itertools.islice(entries2,chunkSize))
+            if not chunk: break
+            yield chunk,source,dest
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for results in pool.imap(convert_job,chunks()):
+            for r in results: yield r
+        pool.close()
+    finally: pool.terminate() ; pool.join()
+
+def jobs_option():
+    "Returns N if --jobs N is on the command line, otherwise 1"
+    if not '--jobs' in sys.argv: return 1
+    try: return max(1,int(sys.argv[sys.argv.index('--jobs')+1]))
+    except (IndexError,ValueError): raise Message("--jobs needs a number of processes")
+
+source_tries = {} # sourceName -> trie of all phoneme keys in that format and their phoneme IDs (for source_keys and parse)
+def source_trie(sourceName):
+    trie = source_tries.get(sourceName,None)
+    if trie==None: trie = source_tries[sourceName] = make_trie(dict((k,v) for k,v in lexFormats[sourceName].items() if not type(k)==tuple and not type(v) in [str,unicode]))
+    return trie
+def source_cvtOut(sourceName,pronunc):
+    "Applies sourceName's cvtOut settings to pronunc, as Converter.split does"
+    source = lexFormats[sourceName]
+    cvtOut_func = source.get(('settings','cvtOut_func'),"")
+    if cvtOut_func: pronunc=cvtOut_func(pronunc)
+    for s,r in source[('compiled','cvtOut_regexps')]:
+        pronunc=s.sub(r,pronunc)
+    return pronunc
+def source_keys(sourceName,pronunc):
+    "Returns the list of keys of sourceName's table that pronunc is made of (after its cvtOut settings, using the longest match each time), or None if some character of pronunc is not part of any key"
+    trie = source_trie(sourceName) ; pronunc = source_cvtOut(sourceName,pronunc)
+    keys = [] ; i = 0
+    while i < len(pronunc):
+        match = longest_match(trie,pronunc,i)
+        if not match: return None
+        keys.append(match[0]) ; i += len(match[0])
+    return keys
+
+def convert_to_all(clauses,source,dests):
+    """Generator giving (dest,convert(clauses,source,dest)) for each of the formats in dests, but splitting up each different source word only once instead of once per dest (for --phones all etc).  clauses is a list of lists of words.  If a dest can't take all of a word's phonemes, or some of its characters aren't recognised, that word is converted in the normal way for that dest, so the results (and any warnings) are the same as calling convert for each dest."""
+    if len(dests)==1:
+        yield dests[0],convert(clauses,source,dests[0]) ; return
+    keys,words = {},[] # (words in order, so any warnings come out in the same order as they would from convert)
+    for clause in clauses:
+        for w in clause:
+            if not w in keys:
+                keys[w] = source_keys(source,w) ; words.append(w)
+    for dest in dests:
+        if dest==source:
+            yield dest,clauses ; continue
+        c = get_converter(source,dest) ; d = c.dictionary ; done = {}
+        for w in words:
+            k = keys[w]
+            if k==None or not all(x in d for x in k): done[w] = c.convert(w)
+            else: done[w] = c.render([d[x] for x in k])
+        yield dest,[[done[w] for w in clause] for clause in clauses]
+
+id_settings = {('settings','stress_comes_before_vowel'):True, ('compiled','cvtOut_regexps'):[]} # the "source format" of render (parse moves stress marks to before their vowels)
+def parse(pronunc,source):
+    """Returns an array('d') of the phoneme IDs (see Phonemes) that pronunc in the source format is made of, including any stress marks and syllable separators.  This does not depend on any dest format, so it can be stored once and given to render for each format needed.
+    If source puts stress marks after the vowel, they are moved to before it.  Characters that are not recognised are dropped (with a warning unless safe_to_drop_characters says otherwise) as in convert."""
+    safe_to_drop = lexFormats[source].get(('settings','safe_to_drop_characters'),"")
+    stress_before = lexFormats[source].get(('settings','stress_comes_before_vowel'),"")
+    trie = source_trie(source) ; pronunc = source_cvtOut(source,pronunc)
+    ret = array.array('d') ; i = 0 ; debugInfo=""
+    while i < len(pronunc):
+        match = longest_match(trie,pronunc,i)
+        if not match:
+            if safe_to_drop==True: pass
+            elif (not safe_to_drop) or not pronunc[i] in safe_to_drop and not (pronunc[i],debugInfo) in warnedAlready:
+                warnedAlready.add((pronunc[i],debugInfo))
+                sys.stderr.write("Warning: ignoring "+source+" character "+repr(pronunc[i])+debugInfo+" (not a phoneme)\n")
+            i += 1 ; continue
+        key,v = match
+        debugInfo=" after "+key ; i += len(key)
+        if v in [primary_stress,secondary_stress] and not stress_before: # move it to before the vowel, as Converter.render does
+            r=len(ret)
+            while r and int(ret[r-1]) in consonants: r -= 1
+            if r: r-=1
+            ret.insert(r,v)
+        else: ret.append(v)
+    return ret
+
+def render(ids,dest):
+    """Makes a pronunciation in the dest format from phoneme IDs given by parse.  A variant that dest doesn't have is rendered as its main phoneme; other phonemes that dest doesn't have are dropped with a warning.
+    The result is usually the same as convert gives from the original string, but can differ when convert would have broken a phoneme that dest doesn't have into parts (parse can't know which dest will be used), and convert adds syllable separators after stress marks it moves to before the vowel, which render doesn't as it no longer knows where the stress marks were in the source."""
+    c = get_converter(None,dest) ; d = c.dictionary
+    def phones():
+        for i in ids:
+            if i in d: yield d[i]
+            elif int(i) in d: yield d[int(i)]
+            elif not (i,dest) in warnedAlready:
+                warnedAlready.add((i,dest))
+                sys.stderr.write("Warning: ignoring phoneme "+repr(i)+" (unsupported in "+dest+")\n")
+    return c.render(phones())
+
+phoneme_ids = [] # all phoneme IDs in order (set by LexFormats); encode_ids stores positions in this list
+phoneme_codes = {} # phoneme ID -> its position in phoneme_ids
+def ids_typecode():
+    if len(phoneme_ids) > 256: return 'H'
+    else: return 'B'
+def encode_ids(ids):
+    """Packs phoneme IDs (as given by parse) into a string of 1 byte per phoneme (2 if there are ever more than 256 phonemes), for keeping a large number of pronunciations in memory (see parse_festival_dict).  Use decode_ids to get the IDs back.  The codes depend on the phonemes defined in Phonemes(), so don't keep the strings for use with a different version of lexconvert."""
+    return array.array(ids_typecode(),[phoneme_codes[i] for i in ids]).tostring()
+def decode_ids(encoded):
+    "Unpacks a string from encode_ids into an array('d') of phoneme IDs for render"
+    codes = array.array(ids_typecode()) ; codes.fromstring(encoded)
+    return array.array('d',[phoneme_ids[c] for c in codes])
 
 def unicode_preprocess(pronunc):
    "Special-case cvtOut_func for unicode-ipa: tries to catch \\uNNNN etc"
@@ -2657,22 +3289,55 @@ def espeak_probably_right_already(existing_pronunc,new_pronunc):
     # TODO: rewrite @ to 3 whenever not followed by a vowel?
     if simplify(existing_pronunc)==simplify(new_pronunc): return True # almost the same, and festival @/a2 etc seems to be a bit ambiguous so leave it alone
 
-def parse_festival_dict(festival_location):
-    "For OALD; yields word,part-of-speech,pronunciation"
-    ret = []
-    for line in open(festival_location).xreadlines():
+festival_dict_pos = frozenset(['n','v','a','cc','dt','in','j','k','nil','prp','uh']) # (other parts of speech are for two or more words)
+def parse_festival_dict(festival_location,encoded=False):
+    """For OALD; yields word,part-of-speech,pronunciation.  If encoded is True, each pronunciation is parsed into an encode_ids string, which takes much less memory than the original if the entries are all being kept (use render(decode_ids(pronunc),format) to get a pronunciation back)."""
+    for line in open(festival_location):
         line=line.strip()
-        if "((pos" in line: line=line[:line.index("((pos")]
-        if line.startswith('( "'): line=line[3:]
-        line=line.replace('"','').replace('(','').replace(')','')
-        try:
-            word, pos, pronunc = line.split(None,2)
-        except ValueError: continue # malformed line
-        if pos not in ['n','v','a','cc','dt','in','j','k','nil','prp','uh']: continue # two or more words
+        i = line.find("((pos")
+        if i >= 0: line=line[:i]
+        if line[:3]=='( "': line=line[3:]
+        fields = line.translate(None,'"()').split(None,2)
+        if len(fields) < 3: continue # malformed line
+        word, pos, pronunc = fields
+        if not pos in festival_dict_pos: continue
+        pos = intern(pos) # (only a few different ones)
+        if encoded: pronunc = encode_ids(parse(pronunc,"festival"))
         yield (word.lower(), pos, pronunc)
 
+festival_token = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|[^\s()\'";]+|;') # string, bracket, atom or start of comment (quote characters are skipped)
+festival_entry_line = re.compile(r'\s*\(lex\.add\.entry\s+\'\(\s*"([^"\\]*)"\s+[^\s()"]+\s+([^;"]*)\)\)\s*(?:;.*)?$') # a whole entry on one line (the usual case, which can be done more quickly)
+festival_atom = re.compile(r"[^\s()']+")
+def read_festival_lexicon(lexfile):
+    """Generator giving (word,pronunciation) for each lex.add.entry in a .festivalrc file, reading it a line at a time.  The file's other commands are skipped, and entries can go over more than one line.  Each pronunciation is all the atoms after the part of speech, without the brackets (e.g. " h @ 0 l ou 1 ")."""
+    stack = [[]] # the lists being read (the bottom one gets each complete top-level form, which is then checked and thrown away)
+    for line in lexfile:
+        if len(stack)==1:
+            m = festival_entry_line.match(line)
+            if m and m.group(2).count('(')==m.group(2).count(')'):
+                yield m.group(1), " "+" ".join(festival_atom.findall(m.group(2)))+" "
+                continue
+        for token in festival_token.findall(line):
+            if token==';': break # comment to end of line
+            elif token=='(': stack.append([])
+            elif token==')':
+                if len(stack)==1: continue # unbalanced, ignore
+                l = stack.pop() ; stack[-1].append(l)
+            else: stack[-1].append(token)
+            if len(stack)==1 and stack[0]:
+                form = stack[0].pop()
+                if type(form)==list and len(form)==2 and form[0]=="lex.add.entry" and type(form[1])==list and len(form[1])>=3 and form[1][0].startswith('"'):
+                    yield form[1][0][1:-1], " "+" ".join(festival_atoms(form[1][2:]))+" "
+
+def festival_atoms(l):
+    "Generator giving the atoms of nested list l (from read_festival_lexicon) in order"
+    for x in l:
+        if type(x)==list:
+            for a in festival_atoms(x): yield a
+        else: yield x
+
 class Message(Exception): pass
-def convert_system_festival_dictionary_to_espeak(festival_location,check_existing_pronunciation,add_user_dictionary_also):
+def convert_system_festival_dictionary_to_espeak(festival_location,check_existing_pronunciation,add_user_dictionary_also,jobs=1):
     "See mainopt_festival_dictionary_to_espeak"
     os.system("mv en_extra en_extra~") # start with blank 'extra' dictionary
     if check_existing_pronunciation: os.system("espeak --compile=en") # so that the pronunciation we're checking against is not influenced by a previous version of en_extra
@@ -2680,7 +3345,9 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
     print "Reading dictionary lists"
     wordDic = {} ; ambiguous = {}
     for line in filter(lambda x:x.split() and not re.match(r'^[a-z]* *\$',x),open("en_list").read().split('\n')): ambiguous[line.split()[0]]=ambiguous[line.split()[0]+'s']=True # this stops the code below from overriding anything already in espeak's en_list.  If taking out then you need to think carefully about words like "a", "the" etc.
+    import time ; startTime,entries = time.time(),0
     for word,pos,pronunc in parse_festival_dict(festival_location):
+        entries += 1
         pronunc=pronunc.replace("i@ 0 @ 0","ii ou 2 ").replace("i@ 0 u 0","ii ou ") # (hack for OALD's "radio"/"video"/"stereo"/"embryo" etc)
         pronunc=pronunc.replace("0","") # 0's not necessary, and OALD sometimes puts them in wrong places, confusing the converter
         if word in ['mosquitoes']: continue # OALD bug (TODO: any others?)
@@ -2689,18 +3356,10 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
             del wordDic[word] # better not go there
         if not ambiguous.has_key(word):
             wordDic[word] = (pronunc, pos)
-    toDel = []
-    if check_existing_pronunciation:
-        print "Checking existing pronunciation"
-        proc=os.popen("espeak -q -x -v en-rp > /tmp/.pronunc 2>&1","w")
-        wList = []
-    progressCount=0 ; oldPercent=-1
+    elapsed = time.time()-startTime
+    print "Read %d entries in %.1f seconds (%d per second)" % (entries,elapsed,entries/max(elapsed,0.001))
+    toDel = [] ; wList = []
     for word,(pronunc,pos) in wordDic.items():
-        if check_existing_pronunciation:
-            percent = int(progressCount*100/len(wordDic))
-            if not percent==oldPercent: sys.stdout.write(str(percent)+"%\r") ; sys.stdout.flush()
-            oldPercent=percent
-            progressCount += 1
         if not re.match("^[A-Za-z]*$",word): # (some versions of eSpeak also OK with "-", but not all)
             # contains special characters - better not go there
             toDel.append(word)
@@ -2711,14 +3370,10 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
             # unnecessary plural (espeak will pick up on them anyway)
             toDel.append(word)
         elif word.startswith("year") or "quarter" in word: toDel.append(word) # don't like festival's pronunciation of those (TODO: also 'memorial' why start with [m'I])
-        elif check_existing_pronunciation:
-            proc.write(word+"\n")
-            proc.flush() # so the progress indicator works
-            wList.append(word)
+        elif check_existing_pronunciation: wList.append(word)
     if check_existing_pronunciation:
-        proc.close() ; print
-        oldPronDic = {}
-        for k,v in zip(wList,open("/tmp/.pronunc").read().split("\n")): oldPronDic[k]=v.strip().replace(" ","")
+        print "Checking existing pronunciation"
+        oldPronDic = espeakWordPronunciations(wList,showProgress=True,jobs=jobs)
     for w in toDel: del wordDic[w]
     print "Doing the conversion"
     lines_output = 0
@@ -2743,23 +3398,15 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
         elif unrelated_word: outFile.write(" (here to stop espeak's affix rules getting confused by Festival's \""+unrelated_word+"\")")
         outFile.write("\n")
     print "Corrected(?) %d entries out of %d" % (lines_output,total_lines)
-    if add_user_dictionary_also: convert_user_lexicon("festival","espeak",outFile)
+    if add_user_dictionary_also: convert_user_lexicon("festival","espeak",outFile,jobs)
     outFile.close()
     os.system("espeak --compile=en")
     if not_output_because_ok:
       print "Checking for unwanted side-effects of those corrections" # e.g. terrible as Terr + ible, inducing as in+Duce+ing
-      proc=os.popen("espeak -q -x -v en-rp > /tmp/.pronunc 2>&1","w")
-      progressCount = 0
-      for w in not_output_because_ok:
-          proc.write(w+"\n") ; proc.flush()
-          percent = int(progressCount*100/len(not_output_because_ok))
-          if not percent==oldPercent: sys.stdout.write(str(percent)+"%\r") ; sys.stdout.flush()
-          oldPercent = percent
-          progressCount += 1
-      proc.close()
+      newPronDic = espeakWordPronunciations(not_output_because_ok,showProgress=True,jobs=jobs)
       outFile=open("en_extra","a") # append to it
-      for word,pronunc in zip(not_output_because_ok,open("/tmp/.pronunc").read().split("\n")):
-        pronunc = pronunc.strip().replace(" ","")
+      for word in not_output_because_ok:
+        pronunc = newPronDic[word]
         if not pronunc==oldPronDic[word] and not espeak_probably_right_already(oldPronDic[word],pronunc):
           outFile.write(word+" "+oldPronDic[word]+" // (undo affix-side-effect from previous words that gave \""+pronunc+"\")\n")
       outFile.close()
@@ -2767,7 +3414,7 @@ def convert_system_festival_dictionary_to_espeak(festival_location,check_existin
     return not_output_because_ok
 
 def read_user_lexicon(fromFormat):
-    "Calls the appropriate lex_read_function, opening lex_filename first if supplied"
+    "Calls the appropriate lex_read_function, opening lex_filename first if supplied.  Most of the read functions give a generator that reads the file as it goes, so don't read it more than once."
     readFunction = checkSetting(fromFormat,"lex_read_function")
     if not readFunction: raise Message("Reading from '%s' lexicon file not yet implemented (no lex_read_function); try using --phones or --phones2phones options instead" % (fromFormat,))
     try:
@@ -2787,22 +3434,59 @@ def replHome(fname):
     
 def get_macuk_lexicon(fromFormat):
     "Converts lexicon from fromFormat and returns a list suitable for MacBritish_System_Lexicon's readWithLex"
-    return [(word,convert(pronunc,fromFormat,"mac-uk")) for word, pronunc in read_user_lexicon(fromFormat)]
+    lex1,lex2 = itertools.tee(read_user_lexicon(fromFormat))
+    return [(word,pronunc) for (word,_),pronunc in itertools.izip(lex1,convert_batch((p for _,p in lex2),fromFormat,"mac-uk"))]
 
 def as_utf8(s):
    if type(s)==unicode: return s.encode('utf-8')
    else: return s
 
-def convert_user_lexicon(fromFormat,toFormat,outFile):
-    "See mainopt_convert"
-    lex = read_user_lexicon(fromFormat)
+def convert_user_lexicon(fromFormat,toFormat,outFile,jobs=1,done=None):
+    "See mainopt_convert.  If done is a dictionary of source pronunciations to converted ones (see read_lexicon_manifest), only the pronunciations that are not in it are converted, and done is changed to have exactly the lexicon's pronunciations."
+    if not done==None:
+        lex = read_user_lexicon(fromFormat)
+        if not type(lex)==list: lex = list(lex)
+        pronuncs = set(p for _,p in lex)
+        new = [p for p in pronuncs if not p in done]
+        reused = dict((p,done[p]) for p in pronuncs if p in done)
+        done.clear() ; done.update(reused)
+        for p,r in itertools.izip(new,convert_batch(new,fromFormat,toFormat,jobs)): done[p] = r
+        print "Converted %d new or changed pronunciations (%d unchanged)" % (len(new),len(reused))
+        return write_lexicon(toFormat,outFile,((word,done[p]) for word,p in lex))
+    if jobs > 1 and not fromFormat==toFormat: return write_lexicon(toFormat,outFile,convert_in_processes(read_user_lexicon(fromFormat),fromFormat,toFormat,jobs)) # (not through tee, as the pool reads the lexicon from another thread)
+    lex1,lex2 = itertools.tee(read_user_lexicon(fromFormat))
+    write_lexicon(toFormat,outFile,itertools.izip((word for word,_ in lex1),convert_batch((p for _,p in lex2),fromFormat,toFormat,jobs)))
+
+def lexicon_manifest_filename(fname): return fname+".lexconvert"
+def file_md5(fname):
+    import hashlib
+    return hashlib.md5(open(fname,"rb").read()).hexdigest()
+def lexconvert_key():
+    "Identifies the version of lexconvert and the environment it's running in (if either has changed, conversions saved by --convert --incremental can't be re-used)"
+    return (file_md5(re.sub(r"\.py[co]$",".py",__file__)), tuple(sorted(ifset_vars)), env_signature())
+def read_lexicon_manifest(fname,fromFormat,toFormat):
+    """Returns the dictionary of source pronunciations to converted ones that --convert --incremental saved when it last wrote the lexicon file fname, or None if there isn't one or fname has been changed since (so it shouldn't be overwritten).
+    If lexconvert or its environment has changed (see lexconvert_key), or the manifest was for a different format, the file can still be overwritten but everything must be converted again, so an empty dictionary is returned."""
+    try: key,md5,done = marshal.loads(open(lexicon_manifest_filename(fname),"rb").read())
+    except (IOError,EOFError,ValueError,TypeError): return None
+    try:
+        if not md5==file_md5(fname): return None
+    except IOError: return None
+    if not key==(lexconvert_key(),fromFormat,toFormat): return {}
+    return done
+def write_lexicon_manifest(fname,fromFormat,toFormat,done):
+    "Saves done (see convert_user_lexicon) for read_lexicon_manifest, along with what fname is now"
+    open(lexicon_manifest_filename(fname),"wb").write(marshal.dumps(((lexconvert_key(),fromFormat,toFormat),file_md5(fname),done)))
+
+def write_lexicon(toFormat,outFile,entries):
+    "Writes toFormat's lexicon header, then each (word,pronunciation) of entries (with the pronunciations already in toFormat), then the footer"
     lex_header = checkSetting(toFormat,"lex_header")
     if type(lex_header)==str: outFile.write(lex_header)
     else: lex_header(outFile)
     entryFormat=getSetting(toFormat,"lex_entry_format")
     wordCase=checkSetting(toFormat,"lex_word_case")
-    for word, pronunc in lex:
-        pronunc = as_utf8(convert(pronunc,fromFormat,toFormat))
+    for word, pronunc in entries:
+        pronunc = as_utf8(pronunc)
         if wordCase=="upper": word=word.upper()
         elif wordCase=="lower": word=word.lower()
         outFile.write(entryFormat % (word,pronunc))
@@ -2950,12 +3634,17 @@ def my_xreadlines():
       except KeyboardInterrupt: raise SystemExit
 
 def output_clauses(format,clauses):
-   "Writes out clauses and words in format 'format' (clauses is a list of lists of words in the phones of 'format').  By default, calls markup_inline_word and join as appropriate.  If however the format's 'clause_separator' has been set to a special case, calls that."
+   "Writes out clauses and words in format 'format' (clauses is a list, or other iterable, of lists of words in the phones of 'format').  By default, calls markup_inline_word and join as appropriate.  If however the format's 'clause_separator' has been set to a special case, calls that."
    if checkSetting(format,"output_is_binary") and hasattr(sys.stdout,"isatty") and sys.stdout.isatty():
       print "This is a binary format - not writing to terminal.\nPlease direct output to a file or pipe."
       return
    clause_sep = checkSetting(format,"clause_separator","\n")
-   if type(clause_sep) in [str,unicode]: sys.stdout.write(clause_sep.join(wordSeparator(format).join(markup_inline_word(format,word) for word in clause) for clause in clauses))
+   if type(clause_sep) in [str,unicode]:
+      word_sep = wordSeparator(format) ; first = True
+      for clause in clauses: # (written a clause at a time, in case clauses is a generator)
+         if first: first = False
+         else: sys.stdout.write(clause_sep)
+         sys.stdout.write(word_sep.join(markup_inline_word(format,word) for word in clause))
    else: clause_sep(clauses)
 def write_bbcmicro_phones(clauses):
   """Special-case function set as clause_separator in bbcmicro format.  Must be a special case because it needs to track any extra keystrokes to avoid "Line too long".  And while we're at it, we might as well start a new *SPEAK command with each clause, using the natural brief delay between commands; this should minimise the occurrence of additional delays in arbitrary places.  Also calls print_bbc_warnings"""
@@ -3130,6 +3819,7 @@ def main():
         if k.startswith('mainopt_') and funcToOpt(k) in sys.argv:
            try: msg = v(sys.argv.index(funcToOpt(k)))
            except Message,e: msg=e.message
+           if os.environ.get("LEXCONVERT_CACHE_STATS",""): sys.stderr.write(cache_stats()+"\n")
            if msg:
               sys.stdout.flush()
               sys.stderr.write(msg+"\n") ; return 1